@@ -9,8 +9,15 @@
 import argparse
 import sqlite3
 from datetime import datetime, date
-from calendar import monthrange
+from functools import lru_cache
 import sys
+from urllib.request import pathname2url
+
+# Optional: apsw is a thinner SQLite wrapper than the standard sqlite3 module
+try:
+    import apsw
+except ImportError:
+    apsw = None
 
 # Program arguments
 parser = argparse.ArgumentParser(prog='mmgrexport.py',
@@ -38,18 +45,125 @@ dateGroup.add_argument('-m', '--month',
                     ' or `Jan\'/`January\', or `Ene\'/`Enero\', etc; case insensitive. Takes precedence over '+
                     ' the other date options' )
 
+parser.add_argument('--driver',
+                    choices=['apsw', 'sqlite3'], default='apsw' if apsw != None else 'sqlite3',
+                    help='SQLite driver used to read the backup file. Defaults to "apsw" if it is installed, ' +
+                    '"sqlite3" otherwise')
+
 parser.add_argument('-d', '--debug',
                     help='Increase program debug messages. Can be specified multiple times ("-dd", "-ddd", etc)',
                     action='count', default=0)
 
+CSV_HEADER = u"fecha;categoría;comentario;importe;forma pago"
+
+# A CSV row: date, category, name, amount, pay_method
+_ROW_FMT = u"{};{};{};{};{}\n"
+
+# Money Manager asset name -> short pay method code
+_PAY_METHOD_MAP = {
+    'Tickets': 'Ti',
+    'Transferencia': 'T',
+    'Efectivo': 'E',
+    'T. Débito': 'TD',
+    'T. Crédito': 'TC',
+    'PayPal': 'P',
+}
+
+# Month names (English and Spanish, lowercase) -> month number
+_MONTH_STR_TO_NUM = {
+    'jan' : 1,
+    'january' : 1,
+    'ene': 1,
+    'enero': 1,
+    'feb': 2,
+    'february': 2,
+    'febrero': 2,
+    'mar': 3,
+    'march': 3,
+    'marzo': 3,
+    'apr': 4,
+    'april': 4,
+    'abr': 4,
+    'abril': 4,
+    'may': 5,
+    'mayo': 5,
+    'jun': 6,
+    'june': 6,
+    'junio': 6,
+    'jul': 7,
+    'july': 7,
+    'julio': 7,
+    'aug': 8,
+    'august': 8,
+    'ago': 8,
+    'agosto': 8,
+    'sep': 9,
+    'september': 9,
+    'septiembre': 9,
+    'oct': 10,
+    'october': 10,
+    'octubre': 10,
+    'nov': 11,
+    'november': 11,
+    'noviembre': 11,
+    'dec': 12,
+    'december': 12,
+    'dic': 12,
+    'diciembre': 12,
+}
+
+# Number of days of each month in a non-leap year
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def daysInMonth(year, month):
+    """Returns the number of days of `month' (1-12) in `year' (Gregorian calendar)"""
+    if month == 2 and (year % 4 == 0 and year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _DAYS_IN_MONTH[month-1]
+
 class MoneyManagerQuery:
     """Extract useful data from a Money Manager database"""
 
-    def __init__(self, dbFilePath, debugLevel):
+    __slots__ = ("dbName", "driver", "dbCon", "queryResult", "startDate", "endDate",
+                 "totalAmount", "debugLevel")
+
+    # z.zdate (cocoa timestamp) is only used for sorting: it is not selected, so it never reaches Python
+    _SQL = ("SELECT z.ztxdatestr, c.zname, z.zcontent, z.zamount, a.znicname, "
+            "SUM(z.zamount) OVER () "               # Total amount, computed in the same scan
+            "FROM ZASSET a, ZCATEGORY c, ZINOUTCOME z "
+            "WHERE z.ztxdatestr BETWEEN ? AND ? "
+            "AND z.zisdel = 0 "                     # zisdel flags deleted entries
+            "AND z.zdo_type = 1 "                   # Type 1 is "expenses"
+            "AND z.ZASSETUID = a.ZUID "             # Join asset (pay method)
+            "AND z.ZCATEGORYUID = c.ZUID "          # Join Category
+            "ORDER BY z.zdate ASC")
+
+    # Connection tuning for a read-only workload
+    _PRAGMAS = (
+        "PRAGMA query_only = 1",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",           # 64 MiB page cache
+        "PRAGMA mmap_size = 268435456",         # Serve pages from a 256 MiB mmap
+    )
+
+    # Number of rows retrieved from the database on each fetch
+    FETCH_SIZE = 1000
+
+    # Number of bytes of CSV output collected by writeCSV() before each write
+    WRITE_SIZE = 64 * 1024
+
+    def __init__(self, dbFilePath, debugLevel, driver='sqlite3'):
         # Init class attributes
         self.dbName = dbFilePath
-        self.dbCon = sqlite3.connect(self.dbName)
-        self.queryStatement = None
+        self.driver = driver
+        # The backup file is only read: open it read-only and in autocommit mode (no implicit transactions)
+        if self.driver == 'apsw':
+            self.dbCon = apsw.Connection(self.dbName, flags=apsw.SQLITE_OPEN_READONLY)
+        else:
+            self.dbCon = sqlite3.connect("file:" + pathname2url(self.dbName) + "?mode=ro", uri=True, isolation_level=None)
+        cursor = self.dbCon.cursor()
+        for pragma in self._PRAGMAS:
+            cursor.execute(pragma)
         self.queryResult = []
         self.startDate = None
         self.endDate = None
@@ -58,47 +172,7 @@ class MoneyManagerQuery:
 
     def __monthStrToNum(self, monthStr):
         """Transforms a string representing the month into a number in the range 1-12"""
-        return {
-            'jan' : 1,
-            'january' : 1,
-            'ene': 1,
-            'enero': 1,
-            'feb': 2,
-            'february': 2,
-            'febrero': 2,
-            'mar': 3,
-            'march': 3,
-            'marzo': 3,
-            'apr': 4,
-            'april': 4,
-            'abr': 4,
-            'abril': 4,
-            'may': 5,
-            'mayo': 5,
-            'jun': 6,
-            'june': 6,
-            'junio': 6,
-            'jul': 7,
-            'july': 7,
-            'julio': 7,
-            'aug': 8,
-            'august': 8,
-            'ago': 8,
-            'agosto': 8,
-            'sep': 9,
-            'september': 9,
-            'septiembre': 9,
-            'oct': 10,
-            'october': 10,
-            'octubre': 10,
-            'nov': 11,
-            'november': 11,
-            'noviembre': 11,
-            'dec': 12,
-            'december': 12,
-            'dic': 12,
-            'diciembre': 12,
-        }.get(monthStr.lower(), 0) # 0 is the default value if not found
+        return _MONTH_STR_TO_NUM.get(monthStr.lower(), 0) # 0 is the default value if not found
 
     def __parseMonth(self, monthStr):
         """Transforms a string into a month in the interval 1-12.
@@ -108,31 +182,29 @@ class MoneyManagerQuery:
         Returns 0 if the month could not be parsed
                 1-12 if the month could be parsed (January: 1)
         """
-        month = 0
+        monthStr = str(monthStr).strip()
 
-        # First, try to obtain a numeric month
-        try:
-            # cast to int
+        # First, try to obtain a numeric month. Check the digits up front instead of catching int() errors;
+        # like int(), accept a leading sign
+        digits = monthStr[1:] if monthStr[:1] in ("+", "-") else monthStr
+        if digits.isdecimal():
             month = int(monthStr)
             if month < 1 or month > 12:
                 # Fallback to current month
                 month = datetime.now().month
-        except:
-            pass
+            return month
 
         # Second, try to obtain the month from a string
-        if  month == 0:
-            month = self.__monthStrToNum(str(monthStr))
-
-        return month
+        return self.__monthStrToNum(monthStr)
 
     def getStartDate(self):
         if self.startDate == None:
             # Use last month if no date requested.
-            if datetime.now().month == 1:
-                self.startDate = date(datetime.now().year-1, 12, 1)
+            now = datetime.now()
+            if now.month == 1:
+                self.startDate = date(now.year-1, 12, 1)
             else:
-                self.startDate = date(datetime.now().year, datetime.now().month-1, 1)
+                self.startDate = date(now.year, now.month-1, 1)
 
         return self.startDate
 
@@ -142,7 +214,7 @@ class MoneyManagerQuery:
 
     def getEndDate(self):
         if self.endDate == None:
-            numberOfDaysInMonth = monthrange(self.getStartDate().year, self.getStartDate().month)[1]
+            numberOfDaysInMonth = daysInMonth(self.getStartDate().year, self.getStartDate().month)
             self.endDate = date(self.getStartDate().year, self.getStartDate().month, numberOfDaysInMonth)
 
         return self.endDate
@@ -159,9 +231,10 @@ class MoneyManagerQuery:
         # Otherwise, remove start and end date (just in case user also put them in command line): we will
         # automatically use last month for dates.
         if month != 0:
-            endDay = monthrange(datetime.now().year, month)[1]
-            self.setStartDate(date(datetime.now().year, month, 1))
-            self.setEndDate(date(datetime.now().year, month, endDay))
+            year = datetime.now().year
+            endDay = daysInMonth(year, month)
+            self.setStartDate(date(year, month, 1))
+            self.setEndDate(date(year, month, endDay))
         else:
             # month == 0
             self.setStartDate(None)
@@ -169,133 +242,148 @@ class MoneyManagerQuery:
 
 
     def getQueryStatement(self):
-        if self.queryStatement == None:
-            localStartDate = str(self.getStartDate())
-            localEndDate = str(self.getEndDate())
-
-            if self.debugLevel >= 1:
-                print ("Date range: " + localStartDate, "-", localEndDate)
-            # TODO: sanitize input
-            self.queryStatement = "SELECT z.zdate, z.ztxdatestr, c.zname, z.zcontent, z.zamount, a.znicname ";
-            self.queryStatement += "FROM ZASSET a, ZCATEGORY c, ZINOUTCOME z ";
-            self.queryStatement += "WHERE z.ztxdatestr ";
-            self.queryStatement += "BETWEEN \""+localStartDate+"\" AND \""+localEndDate+"\" ";
-            self.queryStatement += "AND z.zisdel = 0 ";                  # zisdel flags deleted entries
-            self.queryStatement += "AND z.zdo_type = 1 ";                # Type 1 is "expenses"
-            self.queryStatement += "AND z.ZASSETUID = a.ZUID "           # Join asset (pay method)
-            self.queryStatement += "AND z.ZCATEGORYUID = c.ZUID "        # Join Category
-            self.queryStatement += "ORDER BY z.zdate ASC";
-        return self.queryStatement
+        return self._SQL
 
-    def processDate(self, strDate):
-        (year, month, day) = strDate.split("-")
-        dt = date(int(year), int(month), int(day))
-        return dt.strftime("%d/%m/%Y")
+    def getQueryParameters(self):
+        """Returns the values bound to the placeholders of the query statement"""
+        localStartDate = str(self.getStartDate())
+        localEndDate = str(self.getEndDate())
 
-    def processCategory(self, category):
-        if category.find("/") >= 0:
+        if self.debugLevel >= 1:
+            print ("Date range: " + localStartDate, "-", localEndDate)
+        return (localStartDate, localEndDate)
+
+    def processDate(self, strDate):
+        # "YYYY-MM-DD" -> "DD/MM/YYYY". The query already relies on this fixed format (BETWEEN on strings)
+        return strDate[8:10] + "/" + strDate[5:7] + "/" + strDate[0:4]
+
+    # Only a few dozen distinct categories show up across thousands of transactions
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def processCategory(category):
+        (head, sep, tail) = category.partition("/")
+        if sep:
             # This category is actually "Category/Sub-category"
-            retVal = (category.split("/"))[1]
+            retVal = tail.partition("/")[0]
         else:
-            retVal= category
+            retVal = category
 
         return retVal.strip()
         
     def processAmount(self, amount):
-        # Transform "x.y" into "x,y". Grab only 2 elems after split(), just in case (I don't trust DB data)
-        (amt_integer, amt_cents) = str(amount).split(".")[:2]
-
-        # Put a nice ending "0" in the cents part if needed
-        if len(str(amt_cents)) < 2:
-            amt_cents = str(amt_cents) + "0"
-        return ",".join([amt_integer, amt_cents])
+        # Transform x.y into "x,yy": always 2 decimals, also for integer amounts (I don't trust DB data)
+        return format(float(amount), '.2f').replace('.', ',')
 
 
     def processPaymentMethod(self, pm):
-        retVal = ""
         pm = pm.strip()
 
         if self.debugLevel >= 2:
             print("pay mehtod: '" + pm + "'")
-        if pm == "Tickets":
-            retVal = "Ti"
-        elif pm == u"Transferencia":
-            retVal = "T"
-        elif pm == "Efectivo":
-            retVal = "E"
-        elif pm == u"T. Débito":
-            retVal = "TD"
-        elif pm == "T. Crédito":
-            retVal = "TC"
-        elif pm == "PayPal":
-            retVal = "P"
-        else:
-            retVal = "INVALID"
 
-        return retVal
+        return _PAY_METHOD_MAP.get(pm, "INVALID")
 
     def processName(self, tr_name):
         return tr_name.strip()
 
-    def getResult(self):
-        """Returns list with all the selected transactions, already formatted
+    def fetchTransactions(self):
+        """Yields the raw selected transactions, fetched from the database in batches of FETCH_SIZE rows
 
-        Each element in the list is a list [date, category, name, amount, pay_method]
+        totalAmount is set from the query itself: every row carries the total of the selection.
         """
-        result = []
         cursor = self.dbCon.cursor()
+        cursor.execute(self.getQueryStatement(), self.getQueryParameters())
+        self.totalAmount = 0
 
-        for transaction in cursor.execute(self.getQueryStatement()):
-            if self.debugLevel >= 1:
+        if self.driver == 'apsw':
+            # apsw cursors step the statement directly: there are no batches to tune
+            for transaction in cursor:
+                self.totalAmount = transaction[5]
+                yield transaction
+            return
+
+        cursor.arraysize = self.FETCH_SIZE
+        while True:
+            batch = cursor.fetchmany()
+            if not batch:
+                break
+            self.totalAmount = batch[0][5]
+            for transaction in batch:
+                yield transaction
+
+    def processTransactions(self):
+        """Yields the selected transactions, each one formatted as a tuple (date, category, name, amount, pay_method)"""
+        # Look the formatting methods up once, not once per transaction
+        debug = self.debugLevel >= 1
+        processDate = self.processDate
+        processCategory = self.processCategory
+        processName = self.processName
+        processAmount = self.processAmount
+        processPaymentMethod = self.processPaymentMethod
+
+        for transaction in self.fetchTransactions():
+            if debug:
                 print (transaction)
 #Zutime: timestamp (unix format con millis) of record creation
 #Zdate : timestamp (cocoa format) del gasto. https://www.thecodeship.com/general/converting-cocoa-unix-timestamp/
-            row = []
-            (tr_cocoa_timestamp, tr_date, tr_category, tr_name, tr_amount, tr_pay_method) = transaction
+            (tr_date, tr_category, tr_name, tr_amount, tr_pay_method, tr_total_amount) = transaction
 
-            # tr_cocoa_timestamp: skip. Left here as a reminder.
-            
-            # tr_date:
-            row.append(self.processDate(tr_date))
-
-            # tr_category:
-            row.append(self.processCategory(tr_category))
-
-            # tr_name
-            row.append(self.processName(tr_name))
-
-            # tr_amount:
-            row.append(self.processAmount(tr_amount))
-
-            # tr_pay_method:
-            row.append(self.processPaymentMethod(tr_pay_method))
+            # tr_total_amount: skip, already in totalAmount.
 
             # Current row is ready
-            result.append(row)
+            yield (processDate(tr_date),
+                   processCategory(tr_category),
+                   processName(tr_name),
+                   processAmount(tr_amount),
+                   processPaymentMethod(tr_pay_method))
 
-            # Accumulate total amount
-            self.totalAmount += tr_amount
+    def getResult(self):
+        """Returns list with all the selected transactions, already formatted
 
-        return result
+        Each element in the list is a tuple (date, category, name, amount, pay_method)
+        """
+        return list(self.processTransactions())
 
     def toString(self):
-        retVal = u"fecha;categoría;comentario;importe;forma pago\n";
-        for transaction in self.getResult():
-            for i in range(4):
-                retVal += transaction[i] + u";"
+        # Format each transaction as it is fetched: no intermediate list of transactions (see getResult())
+        lines = [CSV_HEADER + u"\n"]
+        rowFormat = _ROW_FMT.format
+        for transaction in self.processTransactions():
+            lines.append(rowFormat(*transaction))
 
-            retVal += transaction[4] + u"\n"
-
-        retVal += "Total: " + str(round(self.totalAmount, 2));
-        return retVal
+        lines.append("Total: " + str(round(self.totalAmount, 2)))
+        return u"".join(lines)
 
     def toCSV(self):
         return self.toString()
 
+    def writeCSV(self, out):
+        """Writes the selected transactions as UTF-8 encoded CSV into the binary stream `out'
+
+        Unlike toCSV(), rows are written as they are fetched from the database,
+        so the whole export is never held in memory: encoded rows are collected
+        in a buffer that is handed to `out' every WRITE_SIZE bytes.
+        """
+        write = out.write
+        writeSize = self.WRITE_SIZE
+        rowFormat = _ROW_FMT.format
+        buf = bytearray((CSV_HEADER + u"\n").encode("utf-8"))
+
+        for transaction in self.processTransactions():
+            buf += rowFormat(*transaction).encode("utf-8")
+            if len(buf) >= writeSize:
+                write(buf)
+                buf.clear()
+
+        buf += ("Total: " + str(round(self.totalAmount, 2)) + u"\n").encode("utf-8")
+        write(buf)
+
 if __name__ == "__main__":
     args = parser.parse_args()
+    if args.driver == 'apsw' and apsw == None:
+        parser.error('driver "apsw" requested, but the apsw module is not installed')
 
-    mmquery = MoneyManagerQuery(args.sqlite3_file, args.debug)
+    mmquery = MoneyManagerQuery(args.sqlite3_file, args.debug, args.driver)
     # TODO: sanitize input
     if args.month != None:
         mmquery.setMonth(args.month)
@@ -303,5 +391,6 @@ if __name__ == "__main__":
         mmquery.setStartDate(args.start)
         mmquery.setEndDate(args.end)
 
-    result = mmquery.toCSV()
-    print (result)
+    # CSV goes straight to the binary layer of stdout: flush any pending text first
+    sys.stdout.flush()
+    mmquery.writeCSV(sys.stdout.buffer)